@@ -26,6 +26,8 @@ from kiauto.misc import (WRONG_ARGUMENTS, KICAD_VERSION_5_99, Config, READ_ONLY_
 from kiauto import log
 logger = log.get_logger(__name__)
 time_out_scale = 1.0
+# Buffer size for the interposer dialog log
+INTERPOSER_LOG_BUFFER = 1 << 16
 
 
 def set_time_out_scale(scale):
@@ -364,7 +366,8 @@ def get_log_files(out_dir, app_name, also_interposer=False):
     if also_interposer:
         os.makedirs(out_dir, exist_ok=True)
         fname = os.path.join(out_dir, app_name+'_interposer.log')
-        flog_int = open(fname, 'wt')
+        # Written all at once when dumping the dialog, use a big buffer to reduce the number of writes
+        flog_int = open(fname, 'wt', buffering=INTERPOSER_LOG_BUFFER)
         logger.debug('Saving '+app_name+' interposer dialog to '+fname)
     else:
         flog_int = DEVNULL
@@ -4,36 +4,89 @@
 # License: Apache 2.0
 # Project: KiAuto (formerly kicad-automation-scripts)
 import atexit
+from collections import deque
+from functools import lru_cache
+import logging
 import os
 import platform
 import psutil
-from queue import Queue, Empty
+from queue import Empty
 import re
 import shutil
+from subprocess import TimeoutExpired
 from sys import exit
 from tempfile import mkdtemp
-from threading import Thread
+from threading import Thread, Event
 import time
 from kiauto.misc import KICAD_DIED, CORRUPTED_PCB, PCBNEW_ERROR, EESCHEMA_ERROR
 from kiauto import log
 from kiauto.ui_automation import xdotool, wait_for_window, wait_point, text_replace
 
 KICAD_EXIT_MSG = '>>exit<<'
+# Name of the interposer library
+INTERPOSER_LIB = os.path.abspath(os.path.join(os.path.dirname(__file__), 'interposer', 'libinterposer.so'))
 INTERPOSER_OPS = 'interposer_options.txt'
-IGNORED_DIALOG_MSGS = {'The quick brown fox jumps over the lazy dog.', '0123456789'}
+IGNORED_DIALOG_MSGS = frozenset({'The quick brown fox jumps over the lazy dog.', '0123456789'})
 BOGUS_FILENAME = '#'
 # These dialogs are asynchronous, they can pop-up at anytime.
 # One example is when the .kicad_wks is missing, KiCad starts drawing and then detects it.
 INFO_DIALOGS = {'KiCad PCB Editor Information', 'KiCad Schematic Editor Information'}
+PANGO_PREFIX = 'PANGO:'
+PANGO_PREFIX_LEN = len(PANGO_PREFIX)
+PRE_GTK_TITLE = 'GTK:Window Title:'
+PRE_GTK_TITLE_LEN = len(PRE_GTK_TITLE)
+PRE_GTK_SHOW = 'GTK:Window Show:'
+# Elapsed time reported by KiCad during slow loads
+ELAPSED_R = re.compile(r'PANGO:(\d:\d\d:\d\d)')
+WAIT_MSG = 'Waiting for `{}` starts={} times={}'
+# Lines from KiCad's stdout that we queue
+INTERPOSER_PREFIXES = ('PANGO:', 'GTK:', 'IO:', 'GLX:', '* ')
+# Size of the blocks we read from KiCad's stdout
+READ_SIZE = 65536
+# Messages from KiCad dialogs
+MSG_PCB_LOAD_ERROR = "Error loading PCB '{}'."
+MSG_SCH_LOAD_ERROR = "Error loading schematic '{}'."
+MSG_SCH_FILE_LOAD_ERROR = 'Error loading schematic file "{}".'
+MSG_OPEN_ANYWAY = 'Open Anyway'
+MSG_ALREADY_OPEN_5 = '{} file "{}" is already open.'
+MSG_ALREADY_OPEN_6 = "{} '{}' is already open."
+MSG_ALREADY_RUNNING = '{} is already running. Continue?'
+MSG_SAVE_CHANGES = "Save changes to '{}' before closing?"
+# Maximum number of entries in the interposer dialog
+DIALOG_MAX_LEN = 200000
+# Kind of the interposer dialog entries, the first element of each entry
+DLG_MSG = 0    # (DLG_MSG, text) message from the interposer
+DLG_SNIFF = 1  # (DLG_SNIFF, time, text) message from the interposer collected in sniff mode
+DLG_WAIT = 2   # (DLG_WAIT, strs, starts, times) wait_queue call
+DLG_NOTE = 3   # (DLG_NOTE, text) KiAuto message
+DLG_RUN = 4    # (DLG_RUN, text) a new KiCad run, the times are relative to this point
+DLG_MATCH = (DLG_NOTE, 'KiAuto:match')
+DLG_NEW_RUN = (DLG_RUN, 'KiAuto:New KiCad run')
+# Time we wait for each group of messages from a dialog
+DIALOG_MSGS_WAIT = 0.1
+# Maximum time we wait for the messages of a dialog
+DIALOG_MSGS_MAX_WAIT = 1.2
+# Consecutive waits without messages that we consider the end of a dialog
+DIALOG_MSGS_EMPTY_WAITS = 2
+# Time between checks of the KiCad process status when waiting for it to sleep
+READY_POLL_TIME = 0.01
+# Maximum time we block waiting for a message before checking if KiCad is still running.
+# KiCad exiting closes the pipe and wakes-up the consumer, this is just a safety net.
+EXIT_CHECK_TIME = 1.0
+
+
+@lru_cache(maxsize=1)
+def interposer_supported():
+    """ The interposer library is available for this platform.
+        Cached, this doesn't change during the run. """
+    return os.path.isfile(INTERPOSER_LIB) and platform.system() == 'Linux' and platform.machine() == 'x86_64'
 
 
 def check_interposer(args, logger, cfg):
-    # Name of the interposer library
-    interposer_lib = os.path.abspath(os.path.join(os.path.dirname(__file__), 'interposer', 'libinterposer.so'))
-    if (not os.path.isfile(interposer_lib) or  # The lib isn't there
-       args.disable_interposer or              # The user disabled it
+    interposer_lib = INTERPOSER_LIB
+    if (args.disable_interposer or              # The user disabled it
        os.environ.get('KIAUTO_INTERPOSER_DISABLE') or  # The user disabled it using the environment
-       platform.system() != 'Linux' or 'x86_64' not in platform.platform()):  # Not Linux 64 bits x86
+       not interposer_supported()):  # The lib isn't there or not Linux 64 bits x86
         interposer_lib = None
     else:
         os.environ['LD_PRELOAD'] = interposer_lib
@@ -41,30 +94,61 @@ def check_interposer(args, logger, cfg):
     cfg.use_interposer = interposer_lib
     cfg.enable_interposer = interposer_lib or args.interposer_sniff
     cfg.logger = logger
+    # Computed once, used in the loops that process each interposer message
+    cfg.debug_interposer = cfg.verbose > 1 and logger.isEnabledFor(logging.DEBUG)
+    # The dialog is shared by all the KiCad runs (retries).
+    # Keep the memory usage bounded, only the last part is useful for debug
+    cfg.interposer_dialog = deque(maxlen=DIALOG_MAX_LEN)
+
+
+def format_dialog(cfg):
+    """ Generator to convert the interposer dialog entries into text """
+    last_tm = None
+    for entry in cfg.interposer_dialog:
+        kind = entry[0]
+        if kind == DLG_MSG or kind == DLG_NOTE:
+            yield entry[1]
+        elif kind == DLG_RUN:
+            # Each reader thread has its own time reference
+            last_tm = None
+            yield entry[1]
+        elif kind == DLG_WAIT:
+            yield 'KiAuto:'+WAIT_MSG.format(*entry[1:])
+        elif kind == DLG_SNIFF:
+            # We don't process these messages, so we add the time information
+            tm = entry[1]*1000
+            diff = tm-last_tm if last_tm is not None else 0
+            last_tm = tm
+            yield '>>Interposer<<:{} (@{} D {})'.format(entry[2], round(tm, 3), round(diff, 3))
 
 
 def dump_interposer_dialog(cfg):
     cfg.logger.debug('Storing interposer dialog ({})'.format(cfg.flog_int.name))
     if cfg.enable_interposer and not cfg.use_interposer:
-        try:
-            while True:
-                tm, line = cfg.kicad_q.get(timeout=.1)
-                tm *= 1000
-                diff = 0
-                if cfg.last_msg_time:
-                    diff = tm-cfg.last_msg_time
-                cfg.last_msg_time = tm
-                cfg.interposer_dialog.append('>>Interposer<<:{} (@{} D {})'.format(line[:-1], round(tm, 3), round(diff, 3)))
-        except Empty:
-            pass
-    for ln in cfg.interposer_dialog:
-        cfg.flog_int.write(ln+'\n')
+        cfg.interposer_dialog.extend((DLG_SNIFF, tm, line) for tm, line in cfg.kicad_q.drain())
+    if cfg.interposer_dialog:
+        # Let the file buffer group the writes, so we don't need the whole text in memory
+        cfg.flog_int.writelines(ln+'\n' for ln in format_dialog(cfg))
+        # Don't repeat it if we dump it again
+        cfg.interposer_dialog.clear()
     cfg.flog_int.close()
 
 
 def remove_interposer_print_dir(cfg):
     cfg.logger.debug('Removing temporal dir '+cfg.interposer_print_dir)
-    shutil.rmtree(cfg.interposer_print_dir, ignore_errors=True)
+    # We know the only file inside, no need to walk the tree.
+    # This is an atexit handler, nothing should raise here, rmtree removes what is left.
+    try:
+        os.unlink(cfg.interposer_print_file)
+    except OSError:
+        pass
+    try:
+        os.rmdir(cfg.interposer_print_dir)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        # Not empty or not allowed, like the old code
+        shutil.rmtree(cfg.interposer_print_dir, ignore_errors=True)
 
 
 def create_interposer_print_options_file(cfg):
@@ -86,24 +170,96 @@ def save_interposer_print_data(cfg, tmpdir, fn, ext):
     return os.path.join(tmpdir, fn+'.'+ext)
 
 
-# def flush_queue():
-#     """ Thread safe queue flush """
-#     with cfg.kicad_q.mutex:
-#         cfg.kicad_q.queue.clear()
+class MsgQueue(object):
+    """ Queue for the interposer messages.
+        We have only one producer (the thread reading KiCad's stdout) and one consumer (wait_queue).
+        In this case we don't need the locks and conditions used by queue.Queue, deque.append and
+        deque.popleft are atomic. An event is used to wake-up the consumer. """
+    def __init__(self):
+        self.msgs = deque()
+        self.ev = Event()
+        # The producer found the end of the pipe
+        self.closed = False
+
+    def put_many(self, msgs):
+        """ Add a group of messages, waking-up the consumer only once """
+        if not msgs:
+            return
+        self.msgs.extend(msgs)
+        # Avoid the lock inside set() if the consumer wasn't waiting
+        if not self.ev.is_set():
+            self.ev.set()
+
+    def get(self, timeout):
+        """ Get the next message, raises Empty if nothing arrived in `timeout` seconds """
+        try:
+            return self.msgs.popleft()
+        except IndexError:
+            pass
+        self.ev.clear()
+        # A message could arrive before the clear, and we won't get anything after closing
+        if not self.msgs and not self.closed:
+            self.ev.wait(timeout)
+        try:
+            return self.msgs.popleft()
+        except IndexError:
+            raise Empty
+
+    def close(self):
+        """ No more messages, wake-up the consumer so it can check the process """
+        self.closed = True
+        self.ev.set()
+
+    def drain(self):
+        """ Get all the messages currently in the queue """
+        popleft = self.msgs.popleft
+        return [popleft() for _ in range(len(self.msgs))]
+
+    def put_back(self, msgs):
+        """ Return messages got using drain() to the beginning of the queue """
+        self.msgs.extendleft(reversed(msgs))
 
 
 def enqueue_output(out, queue):
-    """ Read 1 line from the interposer and add it to the queue.
+    """ Read lines from the interposer and add them to the queue.
         Notes:
-        * The queue is thread safe.
-        * When we get an empty string we finish, this is the case for KiCad finished """
-    tm_start = time.time()
-    for line in iter(out.readline, ''):
-        if (line.startswith('PANGO:') or line.startswith('GTK:') or line.startswith('IO:') or line.startswith('GLX:') or
-           line.startswith('* ')):
-            queue.put((time.time()-tm_start, line))
-        # logger.error((time.time()-tm_start, line))
+        * The queue is safe for one producer and one consumer.
+        * The lines are stored without the EOL
+        * We read big blocks directly from the file descriptor, the pipe is opened in binary mode
+        * When we get an empty read we finish, this is the case for KiCad finished.
+          Closing the queue wakes-up the consumer, so it doesn't need to poll KiCad """
+    # Locals for the names used in the loop
+    monotonic = time.monotonic
+    read = os.read
+    put_many = queue.put_many
+    tm_start = monotonic()
+    fd = out.fileno()
+    pending = b''
+    while True:
+        chunk = read(fd, READ_SIZE)
+        tm = monotonic()-tm_start
+        data = pending+chunk
+        if chunk.endswith((b'\n', b'\r')):
+            # Most of the time the block ends with a complete line
+            pending = b''
+        elif chunk:
+            # Process the complete lines, keep the rest for the next read
+            end = max(data.rfind(b'\n'), data.rfind(b'\r'))+1
+            pending = data[end:]
+            data = data[:end]
+        # Decode the whole block at once.
+        # Avoid crashes when KiCad 5 sends an invalid Unicode sequence
+        text = data.decode(errors='ignore')
+        # Only \n, \r and \r\n are EOLs, like the universal newlines used by readline().
+        # Note that str.splitlines() also splits at \f, \v, \x1c-\x1e, \x85, \u2028 and \u2029.
+        # The empty line from \r\n is discarded by the prefix test.
+        if '\r' in text:
+            text = text.replace('\r', '\n')
+        put_many([(tm, line) for line in text.split('\n') if line.startswith(INTERPOSER_PREFIXES)])
+        if not chunk:
+            break
     out.close()
+    queue.close()
 
 
 # https://stackoverflow.com/questions/375427/a-non-blocking-read-on-a-subprocess-pipe-in-python
@@ -113,15 +269,14 @@ def start_queue(cfg):
     if not cfg.enable_interposer:
         return
     cfg.logger.debug('Starting queue thread')
-    cfg.kicad_q = Queue()
-    # Avoid crashes when KiCad 5 sends an invalid Unicode sequence
-    cfg.popen_obj.stdout.reconfigure(errors='ignore')
+    cfg.kicad_q = MsgQueue()
+    # The times in the messages are relative to the start of this thread
+    cfg.last_msg_time = 0
+    cfg.interposer_dialog.append(DLG_NEW_RUN)
     cfg.kicad_t = Thread(target=enqueue_output, args=(cfg.popen_obj.stdout, cfg.kicad_q))
     cfg.kicad_t.daemon = True   # thread dies with the program
     cfg.kicad_t.start()
     cfg.collecting_io = False
-    cfg.last_msg_time = 0
-    cfg.interposer_dialog = []
 
 
 def collect_io_from_queue(cfg):
@@ -129,74 +284,149 @@ def collect_io_from_queue(cfg):
     cfg.collecting_io = True
 
 
-def wait_queue(cfg, strs='', starts=False, times=1, timeout=300, do_to=True, kicad_can_exit=False, with_windows=False):
-    """ Wait for a string in the queue """
+def process_msg(cfg, msg):
+    """ Log a message from the interposer and return its text """
+    tm, line = msg
+    if cfg.debug_interposer:
+        tm *= 1000
+        diff = 0
+        if cfg.last_msg_time:
+            diff = tm-cfg.last_msg_time
+        cfg.last_msg_time = tm
+        cfg.logger.debug('>>Interposer<<:{} (@{} D {})'.format(line, round(tm, 3), round(diff, 3)))
+    cfg.interposer_dialog.append((DLG_MSG, line))
+    # The I/O can be in parallel to the UI
+    if cfg.collecting_io and line.startswith('IO:'):
+        cfg.collected_io.add(line)
+    return line
+
+
+def kicad_exited(cfg, timeout):
+    """ Check if KiCad finished.
+        Once the pipe is closed we just wait for the process, no need to poll it """
+    if not cfg.kicad_q.closed:
+        return cfg.popen_obj.poll() is not None
+    try:
+        cfg.popen_obj.wait(timeout)
+    except TimeoutExpired:
+        return False
+    return True
+
+
+def kicad_died(cfg):
+    cfg.logger.error('KiCad unexpectedly died (error level {})'.format(cfg.popen_obj.poll()))
+    exit(KICAD_DIED)
+
+
+def check_unexpected_window(cfg, line):
+    """ Dismiss a window we aren't expecting.
+        The caller already checked `line` is a window title (PRE_GTK_TITLE) """
+    # The change in the unsaved status is ignored here
+    if cfg.ki5 or not line.endswith(cfg.window_title_end):
+        # We aren't expecting a window, but something seems to be there
+        title = line[PRE_GTK_TITLE_LEN:]
+        if title in INFO_DIALOGS:
+            # Async dialogs
+            dismiss_pcb_info(cfg, title)
+        elif title == 'pcbnew Warning':
+            # KiCad 5 error during post-load, before releasing the CPU
+            dismiss_pcbnew_warning(cfg, title)
+        else:
+            unknown_dialog(cfg, title)
+
+
+def record_wait(cfg, strs, starts=False, times=1):
+    """ Add a wait to the interposer dialog and the debug log """
+    # Formatted only if we need to dump the dialog
+    cfg.interposer_dialog.append((DLG_WAIT, strs, starts, times))
+    if cfg.debug_interposer:
+        cfg.logger.debug(WAIT_MSG.format(strs, starts, times))
+
+
+def record_match(cfg, line, times=1):
+    """ Add a match to the interposer dialog and the debug log """
+    cfg.interposer_dialog.append(DLG_MATCH if times == 1 else (DLG_NOTE, 'KiAuto:match (after {})'.format(times)))
+    if cfg.debug_interposer:
+        cfg.logger.debug('Interposer match: '+line)
+
+
+def next_line(cfg, end_time, kicad_can_exit=False):
+    """ Get the next message from the interposer, waiting until `end_time` (monotonic).
+        Returns None on time-out.
+        If KiCad finished returns KICAD_EXIT_MSG when `kicad_can_exit`, or exits with KICAD_DIED """
+    q = cfg.kicad_q
+    monotonic = time.monotonic
+    while True:
+        remaining = end_time-monotonic()
+        if remaining <= 0:
+            return None
+        try:
+            # Returns immediately if we have messages, otherwise blocks until we get one.
+            # But wake-up from time to time to check if KiCad is alive
+            return process_msg(cfg, q.get(min(remaining, EXIT_CHECK_TIME)))
+        except Empty:
+            if kicad_exited(cfg, min(remaining, EXIT_CHECK_TIME)):
+                if kicad_can_exit:
+                    return KICAD_EXIT_MSG
+                kicad_died(cfg)
+
+
+def wait_one(cfg, target, timeout=300):
+    """ Wait for exactly `target` in the queue.
+        This is wait_queue(cfg, target), specialized for the most common case """
+    if not cfg.use_interposer:
+        return None
+    record_wait(cfg, [target])
+    end_time = time.monotonic()+timeout*cfg.time_out_scale
+    while True:
+        line = next_line(cfg, end_time)
+        if line is None:
+            raise RuntimeError('Timed out waiting for `{}`'.format([target]))
+        if line == target:
+            record_match(cfg, line)
+            return line
+        if line.startswith(PRE_GTK_TITLE):
+            check_unexpected_window(cfg, line)
+
+
+def wait_queue(cfg, strs='', starts=False, times=1, timeout=300, do_to=True, kicad_can_exit=False, with_windows=False,
+               record=True):
+    """ Wait for a string in the queue.
+        Use `record=False` for repeated waits, the caller records them only once """
     if not cfg.use_interposer:
         return None
     if isinstance(strs, str):
         strs = [strs]
-    end_time = time.time()+timeout*cfg.time_out_scale
-    msg = 'Waiting for `{}` starts={} times={}'.format(strs, starts, times)
-    cfg.interposer_dialog.append('KiAuto:'+msg)
-    if cfg.verbose > 1:
-        cfg.logger.debug(msg)
-    while time.time() < end_time:
-        try:
-            tm, line = cfg.kicad_q.get(timeout=.1)
-            line = line[:-1]
-            if cfg.verbose > 1:
-                tm *= 1000
-                diff = 0
-                if cfg.last_msg_time:
-                    diff = tm-cfg.last_msg_time
-                cfg.last_msg_time = tm
-                cfg.logger.debug('>>Interposer<<:{} (@{} D {})'.format(line, round(tm, 3), round(diff, 3)))
-            cfg.interposer_dialog.append(line)
-            # The I/O can be in parallel to the UI
-            if cfg.collecting_io and line.startswith('IO:'):
-                cfg.collected_io.add(line)
-        except Empty:
-            line = ''
-        if line == '' and cfg.popen_obj.poll() is not None:
-            if kicad_can_exit:
-                return KICAD_EXIT_MSG
-            cfg.logger.error('KiCad unexpectedly died (error level {})'.format(cfg.popen_obj.poll()))
-            exit(KICAD_DIED)
-        old_times = times
-        for s in strs:
-            if s == '':
-                # Waiting for anything ... but not for nothing
-                if line != '':
-                    return line
-                continue
-            if starts:
-                if line.startswith(s):
-                    times -= 1
-                    break
-            elif line == s:
-                times -= 1
-                break
-        if times == 0:
-            cfg.interposer_dialog.append('KiAuto:match')
-            cfg.logger.debug('Interposer match: '+line)
+    # An empty string means we are waiting for any message
+    any_msg = '' in strs
+    # Only what we need for the kind of match:
+    # - str.startswith accepts a tuple, so all the prefixes are tested in C
+    # - a set for exact matches
+    if starts:
+        prefixes = tuple(s for s in strs if s)
+    else:
+        exact = frozenset(s for s in strs if s)
+    matches = times
+    # Note that window title change is normal when we expect KiCad exiting
+    check_windows = not with_windows and not kicad_can_exit
+    # Monotonic: not affected by clock adjustments
+    end_time = time.monotonic()+timeout*cfg.time_out_scale
+    if record:
+        record_wait(cfg, strs, starts, times)
+    while True:
+        line = next_line(cfg, end_time, kicad_can_exit)
+        if line is None:
+            break
+        if any_msg or line is KICAD_EXIT_MSG:
+            # Waiting for anything, or KiCad finished
             return line
-        if old_times != times:
-            cfg.interposer_dialog.append('KiAuto:times '+str(times))
-            cfg.logger.debug('Interposer match, times='+str(times))
-        if (not with_windows and not kicad_can_exit and line.startswith('GTK:Window Title:') and
-            # The change in the unsaved status is ignored here
-           not(not cfg.ki5 and line.endswith(cfg.window_title_end))):
-            # We aren't expecting a window, but something seems to be there
-            # Note that window title change is normal when we expect KiCad exiting
-            title = line[17:]
-            if title in INFO_DIALOGS:
-                # Async dialogs
-                dismiss_pcb_info(cfg, title)
-            elif title == 'pcbnew Warning':
-                # KiCad 5 error during post-load, before releasing the CPU
-                dismiss_pcbnew_warning(cfg, title)
-            else:
-                unknown_dialog(cfg, title)
+        if (line.startswith(prefixes) if starts else line in exact):
+            times -= 1
+            if times == 0:
+                record_match(cfg, line, matches)
+                return line
+        if check_windows and line.startswith(PRE_GTK_TITLE):
+            check_unexpected_window(cfg, line)
     if do_to:
         raise RuntimeError('Timed out waiting for `{}`'.format(strs))
 
@@ -210,11 +440,9 @@ def wait_swap(cfg, times=1, kicad_can_exit=False):
 
 def set_kicad_process(cfg, pid):
     """ Translates the PID into a psutil object, stores it in cfg """
-    for process in psutil.process_iter():
-        if process.pid == pid:
-            cfg.kicad_process = process
-            break
-    else:
+    try:
+        cfg.kicad_process = psutil.Process(pid)
+    except psutil.NoSuchProcess:
         cfg.logger.error('Unable to map KiCad PID to a process')
         exit(1)
 
@@ -228,9 +456,14 @@ def wait_kicad_ready_i(cfg, swaps=0, kicad_can_exit=False):
             cfg.logger.debug('= KiCad still running after {} swaps, waiting more'.format(swaps))
         else:
             cfg.logger.debug('= KiCad still running, waiting more')
+        kicad_status = cfg.kicad_process.status
+        # We poll the status very often, record the wait only once
+        record_wait(cfg, ['GLX:Swap'], True)
         try:
-            while cfg.kicad_process.status() != psutil.STATUS_SLEEPING:
-                new_res = wait_queue(cfg, 'GLX:Swap', starts=True, timeout=0.1, do_to=False, kicad_can_exit=kicad_can_exit)
+            while kicad_status() != psutil.STATUS_SLEEPING:
+                # Note: this blocks until we get a swap or the time-out, no need to sleep
+                new_res = wait_queue(cfg, 'GLX:Swap', starts=True, timeout=READY_POLL_TIME, do_to=False,
+                                     kicad_can_exit=kicad_can_exit, record=False)
                 if new_res is not None:
                     res = new_res
         except psutil.NoSuchProcess:
@@ -250,19 +483,18 @@ def open_dialog_i(cfg, name, keys, no_show=False, no_wait=False, no_main=False,
     if isinstance(keys, str):
         keys = ['key', keys]
     xdotool(keys)
-    pre_gtk_title = 'GTK:Window Title:'
-    pre_gtk = pre_gtk_title if no_show else 'GTK:Window Show:'
+    pre_gtk = PRE_GTK_TITLE if no_show else PRE_GTK_SHOW
     if isinstance(name, str):
         name = [name]
     name_w_pre = [pre_gtk+f for f in name]
     # Add the async dialogs
     for t in INFO_DIALOGS:
-        name_w_pre.append(pre_gtk_title+t)
+        name_w_pre.append(PRE_GTK_TITLE+t)
     # Wait for our dialog or any async dialog
     # Note: wait_queue won't dismiss them because we use "with_windows=True"
     while True:
         res = wait_queue(cfg, name_w_pre, with_windows=True)
-        title = res[len(pre_gtk_title):]
+        title = res[PRE_GTK_TITLE_LEN:]
         if title not in INFO_DIALOGS:
             break
         # Get rid of the info dialog
@@ -273,7 +505,7 @@ def open_dialog_i(cfg, name, keys, no_show=False, no_wait=False, no_main=False,
     if no_wait:
         return name, None
     if not no_main:
-        wait_queue(cfg, 'GTK:Main:In')
+        wait_one(cfg, 'GTK:Main:In')
     # Wait for KiCad to be sleeping
     wait_kicad_ready_i(cfg)
     # The dialog is there, just make sure it has the focus
@@ -282,7 +514,7 @@ def open_dialog_i(cfg, name, keys, no_show=False, no_wait=False, no_main=False,
 
 def check_text_replace(cfg, name):
     """ Wait until we get the file name """
-    wait_queue(cfg, 'PANGO:'+name)
+    wait_one(cfg, PANGO_PREFIX+name)
 
 
 def paste_text_i(cfg, msg, text):
@@ -332,7 +564,7 @@ def send_keys(cfg, msg, keys, closes=None, delay_io=False):
         if isinstance(closes, str):
             closes = [closes]
         for w in closes:
-            wait_queue(cfg, 'GTK:Window Destroy:'+w)
+            wait_one(cfg, 'GTK:Window Destroy:'+w)
         wait_kicad_ready_i(cfg)
 
 
@@ -366,18 +598,42 @@ def wait_create_i(cfg, name, fn=None):
     wait_kicad_ready_i(cfg)
 
 
+def collect_pango_msgs(cfg, msgs):
+    """ Add the text of all the PANGO messages currently in the queue to `msgs`.
+        Returns how many messages we got from the queue """
+    q = cfg.kicad_q
+    pending = q.drain()
+    for c, msg in enumerate(pending, 1):
+        line = process_msg(cfg, msg)
+        if line.startswith(PANGO_PREFIX):
+            msgs.add(line[PANGO_PREFIX_LEN:])
+        elif line.startswith(PRE_GTK_TITLE):
+            # Another window, i.e. an asynchronous info dialog.
+            # The rest of the messages could be for it, return them to the queue.
+            q.put_back(pending[c:])
+            check_unexpected_window(cfg, line)
+            return c
+    return len(pending)
+
+
 def collect_dialog_messages(cfg, title):
     cfg.logger.info(title+' dialog found ...')
     cfg.logger.debug('Gathering potential dialog content')
     msgs = set()
-    for msg in range(12):
-        res = wait_queue(cfg, 'PANGO:', starts=True, timeout=0.1, do_to=False)
-        if res is None:
-            # Some dialogs has less messages
-            continue
-        res = res[6:]
-        if res not in IGNORED_DIALOG_MSGS:
-            msgs.add(res)
+    if cfg.use_interposer:
+        # Take what we already have, then wait until the dialog stops sending messages
+        collect_pango_msgs(cfg, msgs)
+        wait = DIALOG_MSGS_WAIT*cfg.time_out_scale
+        end_time = time.monotonic()+DIALOG_MSGS_MAX_WAIT*cfg.time_out_scale
+        empty_streak = 0
+        while empty_streak < DIALOG_MSGS_EMPTY_WAITS and time.monotonic() < end_time:
+            if not cfg.kicad_q.closed:
+                time.sleep(wait)
+            elif kicad_exited(cfg, wait):
+                # No more messages and KiCad finished
+                kicad_died(cfg)
+            empty_streak = 0 if collect_pango_msgs(cfg, msgs) else empty_streak+1
+        msgs -= IGNORED_DIALOG_MSGS
     cfg.logger.debug('Messages: '+str(msgs))
     return msgs
 
@@ -399,6 +655,20 @@ def unknown_dialog(cfg, title, msgs=None, fatal=True):
     cfg.logger.warning(msg_msgs)
 
 
+def init_dialog_msgs(cfg):
+    """ Compute the dialog messages that depends on the file we load.
+        Call it only once, when cfg.input_file is final """
+    kind = 'PCB' if cfg.is_pcbnew else 'Schematic'
+    fname = os.path.basename(cfg.input_file)
+    cfg.msg_pcb_load_error = MSG_PCB_LOAD_ERROR.format(cfg.input_file)
+    cfg.msg_sch_load_error = MSG_SCH_LOAD_ERROR.format(cfg.input_file)
+    cfg.msg_sch_file_load_error = MSG_SCH_FILE_LOAD_ERROR.format(os.path.abspath(cfg.input_file))
+    cfg.msg_already_open_5 = MSG_ALREADY_OPEN_5.format(kind, cfg.input_file)
+    cfg.msg_already_open_6 = MSG_ALREADY_OPEN_6.format(kind, fname)
+    cfg.msg_already_running = MSG_ALREADY_RUNNING.format('pcbnew' if cfg.is_pcbnew else 'eeschema')
+    cfg.msg_save_changes = MSG_SAVE_CHANGES.format(fname)
+
+
 def dismiss_dialog(cfg, title, keys):
     cfg.logger.debug('Dismissing dialog `{}` using {}'.format(title, keys))
     wait_for_window(title, title, 1)
@@ -411,11 +681,11 @@ def dismiss_error(cfg, title):
     """ KiCad 6: Corrupted PCB/Schematic
         KiCad 5: Newer KiCad needed  for PCB, missing sch lib """
     msgs = collect_dialog_messages(cfg, title)
-    if "Error loading PCB '"+cfg.input_file+"'." in msgs:
+    if cfg.msg_pcb_load_error in msgs:
         # KiCad 6 PCB loading error
         cfg.logger.error('Error loading PCB file. Corrupted?')
         exit(CORRUPTED_PCB)
-    if "Error loading schematic '"+cfg.input_file+"'." in msgs:
+    if cfg.msg_sch_load_error in msgs:
         # KiCad 6 schematic loading error
         cfg.logger.error('Error loading schematic file. Corrupted?')
         exit(EESCHEMA_ERROR)
@@ -438,10 +708,8 @@ def dismiss_error(cfg, title):
 def dismiss_file_open_error(cfg, title):
     """ KiCad 6: File is already opened """
     msgs = collect_dialog_messages(cfg, title)
-    kind = 'PCB' if cfg.is_pcbnew else 'Schematic'
-    fname = os.path.basename(cfg.input_file)
-    if 'Open Anyway' in msgs and kind+" '"+fname+"' is already open." in msgs:
-        cfg.logger.warning('This file is already opened ({})'.format(fname))
+    if MSG_OPEN_ANYWAY in msgs and cfg.msg_already_open_6 in msgs:
+        cfg.logger.warning('This file is already opened ({})'.format(os.path.basename(cfg.input_file)))
         dismiss_dialog(cfg, title, ['Left', 'Return'])
         return
     unknown_dialog(cfg, title, msgs)
@@ -450,9 +718,8 @@ def dismiss_file_open_error(cfg, title):
 def dismiss_already_running(cfg, title):
     """ KiCad 5: Program already running """
     msgs = collect_dialog_messages(cfg, title)
-    kind = 'pcbnew' if cfg.is_pcbnew else 'eeschema'
-    if kind+' is already running. Continue?' in msgs:
-        cfg.logger.warning(kind+' is already running')
+    if cfg.msg_already_running in msgs:
+        cfg.logger.warning(('pcbnew' if cfg.is_pcbnew else 'eeschema')+' is already running')
         dismiss_dialog(cfg, title, 'Return')
         return
     unknown_dialog(cfg, title, msgs)
@@ -462,11 +729,10 @@ def dismiss_warning(cfg, title):
     """ KiCad 5 when already open file (PCB/SCH)
         KiCad 5 with bogus SCH files """
     msgs = collect_dialog_messages(cfg, title)
-    kind = 'PCB' if cfg.is_pcbnew else 'Schematic'
-    if kind+' file "'+cfg.input_file+'" is already open.' in msgs:
+    if cfg.msg_already_open_5 in msgs:
         cfg.logger.error('File already opened by another KiCad instance')
         exit_pcb_ees_error(cfg)
-    if 'Error loading schematic file "'+os.path.abspath(cfg.input_file)+'".' in msgs:
+    if cfg.msg_sch_file_load_error in msgs:
         cfg.logger.error('eeschema reported an error while loading the schematic')
         exit(EESCHEMA_ERROR)
     unknown_dialog(cfg, title, msgs)
@@ -498,7 +764,7 @@ def dismiss_remap_symbols(cfg, title):
 def dismiss_save_changes(cfg, title):
     """ KiCad 5/6 asking for save changes to disk """
     msgs = collect_dialog_messages(cfg, title)
-    if ("Save changes to '"+os.path.basename(cfg.input_file)+"' before closing?" in msgs or   # KiCad 6
+    if (cfg.msg_save_changes in msgs or   # KiCad 6
        "If you don't save, all your changes will be permanently lost." in msgs):  # KiCad 5
         dismiss_dialog(cfg, title, ['Left', 'Left', 'Return'])
         return
@@ -521,21 +787,29 @@ def dismiss_pcb_info(cfg, title):
     dismiss_dialog(cfg, title, 'Return')
 
 
+# Dialogs found during the load process and the function to dismiss them
+LOAD_DIALOGS = {'Error': dismiss_error,
+                'File Open Error': dismiss_file_open_error,
+                'Confirmation': dismiss_already_running,
+                'Warning': dismiss_warning,
+                'pcbnew Warning': dismiss_pcbnew_warning,
+                'Remap Symbols': dismiss_remap_symbols}
+LOAD_DIALOGS.update((t, dismiss_pcb_info) for t in INFO_DIALOGS)
+
+
 def exit_kicad_i(cfg):
     wait_kicad_ready_i(cfg)
     send_keys(cfg, 'Exiting KiCad', 'ctrl+q')
-    pre = 'GTK:Window Title:'
-    pre_l = len(pre)
     retries = 3
     while True:
         # Wait for any window
-        res = wait_queue(cfg, pre, starts=True, timeout=2, kicad_can_exit=True, do_to=False, with_windows=True)
+        res = wait_queue(cfg, PRE_GTK_TITLE, starts=True, timeout=2, kicad_can_exit=True, do_to=False, with_windows=True)
         known_dialog = False
         if res is not None:
             cfg.logger.debug('exit_kicad_i got '+res)
             if res == KICAD_EXIT_MSG:
                 return
-            title = res[pre_l:]
+            title = res[PRE_GTK_TITLE_LEN:]
             if title == 'Save Changes?' or title == '':  # KiCad 5 without title!!!!
                 dismiss_save_changes(cfg, title)
                 known_dialog = True
@@ -570,7 +844,7 @@ def wait_and_show_progress(cfg, msg, regex_str, trigger, msg_reg, skip_match=Non
         msg_reg: Message to print before the info (msg_reg: MATCH)
         skip_match: A match that we will skip
         with_windows: KiCad could pop-up a window """
-    pres = [msg, 'PANGO:'+trigger]
+    pres = [msg, PANGO_PREFIX+trigger]
     regex = re.compile(regex_str)
     with_info = False
     padding = 80*' '
@@ -583,8 +857,8 @@ def wait_and_show_progress(cfg, msg, regex_str, trigger, msg_reg, skip_match=Non
             wait_kicad_ready_i(cfg)
             return
         # Check if this message contains progress information
-        if cfg.verbose and res.startswith('PANGO:'):
-            res = res[6:]
+        if cfg.verbose and res.startswith(PANGO_PREFIX):
+            res = res[PANGO_PREFIX_LEN:]
             match = regex.match(res)
             if match is not None:
                 m = match.group(1)
@@ -596,12 +870,9 @@ def wait_and_show_progress(cfg, msg, regex_str, trigger, msg_reg, skip_match=Non
 
 def wait_start_by_msg(cfg):
     cfg.logger.info('Waiting for PCB new window ...')
-    pre = 'GTK:Window Title:'
-    pre_l = len(pre)
     cfg.logger.debug('Waiting pcbnew to start and load the PCB')
     # Inform the elapsed time for slow loads
-    pres = [pre, 'PANGO:0:']
-    elapsed_r = re.compile(r'PANGO:(\d:\d\d:\d\d)')
+    pres = [PRE_GTK_TITLE, 'PANGO:0:']
     if cfg.is_pcbnew:
         kind = 'PCB'
         prg_name = 'Pcbnew'
@@ -613,15 +884,19 @@ def wait_start_by_msg(cfg):
     loading_msg = 'Loading '+kind
     prg_msg = prg_name+' —'
     with_elapsed = False
+    debug = cfg.logger.debug
+    ki5 = cfg.ki5
+    # Only defined for KiCad 6
+    window_title_end = None if ki5 else cfg.window_title_end
     while True:
         # Wait for any window
         res = wait_queue(cfg, pres, starts=True, timeout=cfg.wait_start, with_windows=True)
-        cfg.logger.debug('wait_pcbew_start_by_msg got '+res)
-        match = elapsed_r.match(res)
-        title = res[pre_l:]
+        debug('wait_pcbew_start_by_msg got '+res)
+        match = ELAPSED_R.match(res)
+        title = res[PRE_GTK_TITLE_LEN:]
         if not match and with_elapsed:
             log.flush_info()
-        if not cfg.ki5 and title.endswith(cfg.window_title_end):
+        if not ki5 and title.endswith(window_title_end):
             # KiCad 6
             if title.startswith('[no schematic loaded]'):
                 # False alarma, nothing loaded
@@ -630,14 +905,14 @@ def wait_start_by_msg(cfg):
             if title[0] == '*':
                 # This is an old format file that will be saved in the new format
                 cfg.logger.warning('Old file format detected, please convert it to KiCad 6 if experimenting problems')
-            wait_queue(cfg, 'GTK:Main:In')
+            wait_one(cfg, 'GTK:Main:In')
             return
-        elif cfg.ki5 and title.startswith(prg_msg):
+        elif ki5 and title.startswith(prg_msg):
             # KiCad 5 title
             if not title.endswith(unsaved):
                 # KiCad 5 name is "Pcbnew — PCB_NAME" or "Eeschema — SCH_NAME [HIERARCHY] — SCH_FILE_NAME"
                 # wait_pcbnew()
-                wait_queue(cfg, ['GTK:Window Show:'+title, 'GTK:Main:In'], starts=True, timeout=cfg.wait_start, times=2,
+                wait_queue(cfg, [PRE_GTK_SHOW+title, 'GTK:Main:In'], starts=True, timeout=cfg.wait_start, times=2,
                            with_windows=True)
                 return
             # The "  [Unsaved]" is changed before the final load, ignore it
@@ -653,19 +928,6 @@ def wait_start_by_msg(cfg):
             if msg != '0:00:00':
                 log.info_progress('Elapsed time: '+msg)
                 with_elapsed = True
-        elif title == 'Error':
-            dismiss_error(cfg, title)
-        elif title == 'File Open Error':
-            dismiss_file_open_error(cfg, title)
-        elif title == 'Confirmation':
-            dismiss_already_running(cfg, title)
-        elif title == 'Warning':
-            dismiss_warning(cfg, title)
-        elif title == 'pcbnew Warning':
-            dismiss_pcbnew_warning(cfg, title)
-        elif title == 'Remap Symbols':
-            dismiss_remap_symbols(cfg, title)
-        elif title in INFO_DIALOGS:
-            dismiss_pcb_info(cfg, title)
         else:
-            unknown_dialog(cfg, title)
+            # Dialogs we know how to dismiss
+            LOAD_DIALOGS.get(title, unknown_dialog)(cfg, title)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2022 Salvador E. Tropea
+# Copyright (c) 2022 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+Tests for the interposer messages processing (no KiCad needed)
+
+For debug information use:
+pytest-3 --log-cli-level debug
+
+"""
+
+import os
+import sys
+import types
+# Look for the 'kiauto' module from where the script is running
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(script_dir)))
+from kiauto import interposer
+
+
+class FakePipe(object):
+    """ KiCad's stdout, os.read is replaced to return the chunks """
+    def fileno(self):
+        return -1
+
+    def close(self):
+        pass
+
+
+def test_enqueue_output_split(monkeypatch):
+    """ Lines split between reads, \\r and \\r\\n EOLs, an UTF-8 char split between reads
+        and chars that str.splitlines() takes as EOL """
+    chunks = [b'noise\nPANGO:Error lo',
+              b'ading\r\nGTK:Window Title:Foo \xe2\x80',
+              b'\x94 PCB Editor\rIO:x\x0cy\xe2\x80\xa8z\r',
+              b'\nGLX:Swap',
+              b'']
+    monkeypatch.setattr(interposer, 'os', types.SimpleNamespace(read=lambda fd, size: chunks.pop(0)))
+    q = interposer.MsgQueue()
+    interposer.enqueue_output(FakePipe(), q)
+    assert [line for _, line in q.drain()] == ['PANGO:Error loading', 'GTK:Window Title:Foo — PCB Editor',
+                                               'IO:x\x0cy\u2028z', 'GLX:Swap']
+    assert q.closed